@@ -1,7 +1,10 @@
+import math
 import os
+import shutil
 import subprocess
-import glob
-import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
 
 def create_output_directory(directory, reference_name):
     output_directory = os.path.join(directory, reference_name)
@@ -9,62 +12,116 @@ def create_output_directory(directory, reference_name):
     return output_directory
 
 def find_reference_fasta(directory):
-    os.chdir(directory)
-    reference_files = [file for file in os.listdir() if file.endswith('.fasta') and not file.startswith('._')]
-    
-    if not reference_files:
+    # Stop scanning as soon as a second candidate shows up rather than
+    # listing the whole directory first
+    found = None
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith('.fasta') and not entry.name.startswith('._'):
+                if found is not None:
+                    raise ValueError("Multiple reference fasta files found. Please ensure only one reference file is present.")
+                found = entry.name
+
+    if found is None:
         raise FileNotFoundError("No reference fasta file found in the specified directory.")
-    
-    if len(reference_files) > 1:
-        raise ValueError("Multiple reference fasta files found. Please ensure only one reference file is present.")
-    
-    return reference_files[0]
+
+    return found
 
 def concatenate_fastq(directory):
-    os.chdir(directory)
-    
-    concatenated_file = 'concatenated.fastq'
+    concatenated_file = os.path.join(directory, 'concatenated.fastq.gz')
 
     if os.path.exists(concatenated_file):
-        print("Using previously generated concatenated.fastq file.")
+        print("Using previously generated concatenated.fastq.gz file.")
         return
-    
-    all_fastq_files = glob.glob('**/*.fastq.gz', recursive=True)
 
-    with open(concatenated_file, 'wb') as outfile:
-        for fastq_file in all_fastq_files:
-            with open(fastq_file, 'rb') as infile:
-                outfile.write(infile.read())
-
-def run_minimap2(reference_file, concatenated_file, output_directory, reference_name):
-    sam_output = os.path.join(output_directory, f'{reference_name}.sam')
-    subprocess.run(['minimap2', '-ax', 'map-ont', reference_file, concatenated_file], stdout=open(sam_output, 'w'))
+    # os.walk is scandir-backed, so this avoids the per-entry stat calls
+    # and fnmatch overhead of glob('**/*.fastq.gz'); skip any
+    # concatenated.fastq.gz temp left in a barcode folder by run_kraken
+    all_fastq_files = [os.path.join(root, name)
+                       for root, dirs, files in os.walk(directory)
+                       for name in files
+                       if name.endswith('.fastq.gz') and name != 'concatenated.fastq.gz']
+
+    if not all_fastq_files:
+        # Without this guard, cat would be run with no arguments and block
+        # reading from the terminal
+        print(f"No fastq.gz files found in {directory}")
+        return
 
-def run_samtools_sort(output_directory, reference_name):
+    # gzip members concatenate natively, so a plain cat produces a valid
+    # multi-member .fastq.gz that minimap2 can read directly
+    try:
+        with open(concatenated_file, 'wb') as outfile:
+            subprocess.run(['cat'] + all_fastq_files, stdout=outfile, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        # Fallback if cat is unavailable or fails: stream each file in
+        # 128 KiB chunks so peak memory stays constant regardless of file size
+        with open(concatenated_file, 'wb') as outfile:
+            for fastq_file in all_fastq_files:
+                with open(fastq_file, 'rb') as infile:
+                    shutil.copyfileobj(infile, outfile, length=131072)
+
+def run_minimap2_sort(reference_file, concatenated_file, output_directory, reference_name):
+    # Pipe minimap2 straight into samtools sort so the uncompressed SAM
+    # (the largest file in the pipeline) never touches disk
     bam_output = os.path.join(output_directory, f'{reference_name}.bam')
-    subprocess.run(['samtools', 'sort', os.path.join(output_directory, f'{reference_name}.sam'), '-o', bam_output])
+    minimap2 = subprocess.Popen(['minimap2', '-ax', 'map-ont', '-t', str(os.cpu_count()), '--secondary=no',
+                                 reference_file, concatenated_file], stdout=subprocess.PIPE)
+    # -l 1: the BAM is an intermediate read once by samtools depth, so fast
+    # compression beats the default level 6
+    sort = subprocess.Popen(['samtools', 'sort', '-@', str(os.cpu_count()), '-m', '1G', '-l', '1',
+                             '-o', bam_output, '-'], stdin=minimap2.stdout)
+    minimap2.stdout.close()  # let samtools see EOF if minimap2 dies
+    if minimap2.wait() != 0:
+        raise subprocess.CalledProcessError(minimap2.returncode, 'minimap2')
+    if sort.wait() != 0:
+        raise subprocess.CalledProcessError(sort.returncode, 'samtools sort')
+
+def run_samtools_index(output_directory, reference_name):
+    # Persist a BAI index so later region queries (depth, IGV) can seek
+    # instead of re-scanning the whole BAM
+    subprocess.run(['samtools', 'index', '-@', str(os.cpu_count()),
+                    os.path.join(output_directory, f'{reference_name}.bam')], check=True)
 
 def run_samtools_depth(output_directory, reference_name):
-    subprocess.run(['samtools', 'depth', '-a', os.path.join(output_directory, f'{reference_name}.bam')],
-                   stdout=open(os.path.join(output_directory, f'{reference_name}.coverage'), 'w'))
+    # The context manager closes (and flushes) the output before the next
+    # step reads it; an inline open() leaks the fd until garbage collection
+    with open(os.path.join(output_directory, f'{reference_name}.coverage'), 'wb') as coverage_file:
+        subprocess.run(['samtools', 'depth', '-a', '-@', str(os.cpu_count()),
+                        os.path.join(output_directory, f'{reference_name}.bam')],
+                       stdout=coverage_file, check=True)
 
 def plot_coverage(output_directory, reference_name):
-    data = {'x': [], 'y': []}
-    with open(os.path.join(output_directory, f'{reference_name}.coverage'), 'r') as coverage_file:
-        for line in coverage_file:
-            columns = line.strip().split('\t')
-            data['x'].append(int(columns[1]))
-            data['y'].append(int(columns[2]))
-
-    horizontal_coverage = sum(1 for val in data['y'] if val > 0) / len(data['y'])
-    vertical_coverage = sum(data['y']) / len(data['y'])
-
-    fig, ax = plt.subplots(figsize=(8, 4))
-    ax.plot(data['x'], data['y'], color='black', linewidth=1.5)
+    # Parse the coverage table in C via pandas instead of splitting each
+    # line in the interpreter
+    df = pd.read_csv(os.path.join(output_directory, f'{reference_name}.coverage'),
+                     sep='\t', header=None, names=['chrom', 'pos', 'depth'],
+                     dtype={'pos': np.int32, 'depth': np.int32}, engine='pyarrow')
+
+    # Statistics are computed on the full per-base arrays
+    horizontal_coverage = (df.depth > 0).mean()
+    vertical_coverage = df.depth.mean()
+
+    # The PDF is only ~600 px wide, so plotting millions of per-base points
+    # just bloats render time and file size; downsample to per-bin maxima
+    x, y = df.pos.values, df.depth.values
+    target = 4000
+    if len(y) > target:
+        # Zero-pad the tail so the final partial bin is kept rather than
+        # truncated; padding is safe under the max reduction
+        bin_size = math.ceil(len(y) / target)
+        pad = -len(y) % bin_size
+        y = np.pad(y, (0, pad)).reshape(-1, bin_size).max(axis=1)
+        x = x[::bin_size]
+
+    # Build the figure through the OO API so no GUI backend is ever probed
+    fig = Figure(figsize=(8, 4))
+    ax = fig.subplots()
+    ax.plot(x, y, color='black', linewidth=1.5)
     ax.set_yscale('log')
     ax.set_xlabel('Genome position')
     ax.set_ylabel('Coverage (reads)')
-    ax.set_title(f"{columns[0]} ({len(data['x'])} nt)", fontweight='bold', loc='left', y=1.08)
+    ax.set_title(f"{df.chrom.iloc[0]} ({len(df)} nt)", fontweight='bold', loc='left', y=1.08)
     ax.grid(which='major', linestyle='-', color='lightgrey')
     ax.minorticks_on()
     ax.grid(which='minor', linestyle='-', color='lightgrey', alpha=0.5)
@@ -78,8 +135,7 @@ def plot_coverage(output_directory, reference_name):
         spine.set_visible(False)
 
     pdf_path = os.path.join(output_directory, f'{reference_name}.pdf')
-    plt.savefig(pdf_path, bbox_inches='tight', pad_inches=0, transparent=True)
-    plt.show()
+    fig.savefig(pdf_path, bbox_inches='tight', pad_inches=0, transparent=True)
 
     print(f"Plot saved as {pdf_path}")
 
@@ -95,10 +151,11 @@ if __name__ == '__main__':
 
     output_directory = create_output_directory(fastq_pass_directory, reference_name)
 
-    os.chdir(fastq_pass_directory)
-    run_minimap2(os.path.join(reference_directory, reference_file), 'concatenated.fastq', output_directory, reference_name)
+    run_minimap2_sort(os.path.join(reference_directory, reference_file),
+                      os.path.join(fastq_pass_directory, 'concatenated.fastq.gz'),
+                      output_directory, reference_name)
 
-    run_samtools_sort(output_directory, reference_name)
+    run_samtools_index(output_directory, reference_name)
 
     run_samtools_depth(output_directory, reference_name)
 
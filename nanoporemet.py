@@ -1,15 +1,20 @@
 import os
 import glob
+import multiprocessing
+import shutil
 import subprocess
-import gzip
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from matplotlib.backends.backend_pdf import PdfPages
 
-def plot_histogram(data, column_name, title, xlabel, ylabel, ax, log_scale=False):
-    n, bins, patches = ax.hist(data[column_name], bins=100, edgecolor='black', log=log_scale, color='white', lw=1.2, zorder=2)
-    median_value = data[column_name].median()
-    rounded_median = round(median_value) if column_name == "sequence_length_template" else round(median_value, 2)
+def plot_histogram(arr, title, xlabel, ylabel, ax, log_scale=False, integer_median=False):
+    # Bin in NumPy and draw the outline as one stairs line instead of
+    # letting ax.hist create a Rectangle patch per bin
+    counts, edges = np.histogram(arr, bins=100)
+    ax.stairs(counts, edges, edgecolor='black', fill=False, lw=1.2, zorder=2)
+    median_value = np.median(arr)
+    rounded_median = round(median_value) if integer_median else round(median_value, 2)
     ax.set_title(f"{title}", loc='left')  # Align title to the left
     ax.set_xlabel(xlabel)
     ax.set_ylabel(ylabel)
@@ -40,79 +45,96 @@ def generate_sequencing_summary_pdf(directory):
     # Take the first matching file (you can modify this logic if needed)
     file_path = files[0]
 
-    # Read the data from the file
-    data = pd.read_csv(file_path, sep='\t')
-
-    # Create histograms and save in one PDF file
+    # Only three of the ~30 summary columns are plotted; cache them as
+    # Parquet next to the TSV so repeat runs skip the multi-GB text parse
+    columns = ['mean_qscore_template', 'sequence_length_template', 'passes_filtering']
+    cache_path = file_path + '.parquet'
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file_path):
+        data = pd.read_parquet(cache_path, columns=columns)
+    else:
+        data = pd.read_csv(file_path, sep='\t', usecols=columns, engine='pyarrow',
+                           dtype={'mean_qscore_template': 'float32',
+                                  'sequence_length_template': 'int32',
+                                  'passes_filtering': 'bool'})
+        data.to_parquet(cache_path)
+
+    # Create histograms and save in one PDF file; a single 2x2 figure
+    # amortizes the renderer and font setup over all four panels
     with PdfPages(pdf_path) as pdf:
-        # Plot for all data
-        fig, axs = plt.subplots(figsize=(8, 6))
-        plot_histogram(data, "mean_qscore_template", "Mean Q score (all reads)",
-                       "Mean Q score", "Frequency", axs)
+        # Build the figure through the OO API so no GUI backend is ever probed
+        fig = Figure(figsize=(16, 12))
+        axs = fig.subplots(2, 2)
+
+        # Index the underlying arrays with the "passes_filtering" mask
+        # instead of materializing a filtered copy of the DataFrame
+        mask = data["passes_filtering"].to_numpy()
+        qscore = data["mean_qscore_template"].to_numpy()
+        length = data["sequence_length_template"].to_numpy()
+
+        plot_histogram(qscore, "Mean Q score (all reads)",
+                       "Mean Q score", "Frequency", axs[0, 0])
+        plot_histogram(qscore[mask], "Mean Q score (quality-filtered reads)",
+                       "Mean Q score", "Frequency", axs[0, 1])
+        plot_histogram(length, "Sequence length (all reads)",
+                       "Sequence length", "Frequency", axs[1, 0], log_scale=True, integer_median=True)
+        plot_histogram(length[mask], "Sequence length (quality-filtered reads)",
+                       "Sequence length", "Frequency", axs[1, 1], log_scale=True, integer_median=True)
 
         pdf.savefig(fig)
-        plt.close(fig)
-
-        # Filter based on the "passes_filtering" column
-        filtered_data = data[data["passes_filtering"] == True]
 
-        # Plot for filtered data
-        fig, axs = plt.subplots(figsize=(8, 6))  # Create a new figure
-        plot_histogram(filtered_data, "mean_qscore_template", "Mean Q score (quality-filtered reads)",
-                       "Mean Q score", "Frequency", axs)
-
-        pdf.savefig(fig)
-        plt.close(fig)
-
-        # Plot for sequence length (all reads)
-        fig, axs = plt.subplots(figsize=(8, 6))  # Create a new figure
-        plot_histogram(data, "sequence_length_template", "Sequence length (all reads)",
-                       "Sequence length", "Frequency", axs, log_scale=True)
-
-        pdf.savefig(fig)
-        plt.close(fig)
+    print(f"Plots saved in {pdf_path}")
+    return pdf_path
 
-        # Plot for sequence length (quality-filtered reads)
-        fig, axs = plt.subplots(figsize=(8, 6))  # Create a new figure
-        plot_histogram(filtered_data, "sequence_length_template", "Sequence length (quality-filtered reads)",
-                       "Sequence length", "Frequency", axs, log_scale=True)
+def directory_is_nonempty(path):
+    # Peek at a single DirEntry rather than iterating the whole directory,
+    # and close the scandir iterator so the fd is released immediately
+    with os.scandir(path) as entries:
+        return next(entries, None) is not None
 
-        pdf.savefig(fig)
-        plt.close(fig)
+def run_kraken(directory, kraken_db, analyze_bacterial, threads=None):
+    # Path to the output .fastq.gz file
+    output_fastq = os.path.join(directory, "concatenated.fastq.gz")
 
-    print(f"Plots saved in {pdf_path}")
-    return pdf_path
+    # Collect fastq.gz files in the directory, excluding our own output so a
+    # leftover temp from an aborted run is never picked up as input
+    fastq_files = [file for file in os.listdir(directory)
+                   if file.endswith('.fastq.gz') and file != os.path.basename(output_fastq)]
 
-def run_kraken(directory, kraken_db, analyze_bacterial):
-    # Path to the output .fastq file
-    output_fastq = os.path.join(directory, "concatenated.fastq")
-    
-    # Collect fastq.gz files in the directory
-    fastq_files = [file for file in os.listdir(directory) if file.endswith('.fastq.gz')]
-    
     # Check if there are fastq.gz files in the directory
     if fastq_files:
-        # Open the output file in binary mode and concatenate the content of fastq.gz files
-        with open(output_fastq, 'wb') as output_handle:
-            for file in fastq_files:
-                with open(os.path.join(directory, file), 'rb') as input_handle:
-                    output_handle.write(input_handle.read())
-        
-        # Run Kraken2 on the concatenated .fastq file
+        # gzip members concatenate natively, so a plain cat produces a valid
+        # multi-member .fastq.gz that kraken2 can read with --gzip-compressed
+        try:
+            with open(output_fastq, 'wb') as output_handle:
+                subprocess.run(['cat'] + [os.path.join(directory, file) for file in fastq_files],
+                               stdout=output_handle, check=True)
+        except (OSError, subprocess.CalledProcessError):
+            # Fallback if cat is unavailable or fails: stream each file in
+            # 128 KiB chunks so peak memory stays constant regardless of file size
+            with open(output_fastq, 'wb') as output_handle:
+                for file in fastq_files:
+                    with open(os.path.join(directory, file), 'rb') as input_handle:
+                        shutil.copyfileobj(input_handle, output_handle, length=131072)
+
+        # Run Kraken2 on the concatenated .fastq.gz file
         output_kraken = os.path.join(directory, f"{os.path.basename(directory)}.kreport.txt")
-        kraken_command = f"kraken2 --db {kraken_db} --output {output_fastq.replace('.fastq', '.kraken')} --report {output_kraken} {output_fastq}"
-        subprocess.run(kraken_command, shell=True)
-        
-        # Add a column with title to the kreport.txt file
-        title = os.path.basename(directory)
-        with open(output_kraken, 'r') as f:
-            lines = f.readlines()
-        lines = [f"{title}\t{line}" for line in lines]  # Prepend the title column
-        with open(output_kraken, 'w') as f:
-            f.writelines(lines)
-        
-        # Cleanup: Remove the concatenated .fastq file after Kraken2 analysis
-        os.remove(output_fastq)
+        kraken_args = ['kraken2', '--db', kraken_db, '--threads', str(threads or os.cpu_count()),
+                       '--gzip-compressed', '--memory-mapping',
+                       '--output', output_fastq.replace('.fastq.gz', '.kraken'),
+                       '--report', output_kraken, output_fastq]
+        try:
+            subprocess.run(kraken_args, check=True)
+
+            # Prepend a title column to the kreport.txt file in one write
+            title_prefix = f"{os.path.basename(directory)}\t"
+            with open(output_kraken, 'r') as f:
+                lines = f.readlines()
+            with open(output_kraken, 'w') as f:
+                f.write(title_prefix + title_prefix.join(lines))
+        finally:
+            # Cleanup: Remove the concatenated .fastq.gz even when Kraken2
+            # fails, so no temp survives into the next run
+            os.remove(output_fastq)
     else:
         print(f"No fastq.gz files found in {directory}")
 
@@ -134,35 +156,41 @@ def main():
         kraken_db_path = "/data/kraken_databases/k2_human-viral_20240111/"
         output_file_name = "virus.kraken.txt"
 
-    # List to store individual kreport.txt DataFrames
-    kreport_dfs = []
-
-    # Navigate through each sub-folder in "fastq_pass" and run Kraken2 analysis
+    # Collect the non-empty sub-folders of "fastq_pass"
     fastq_pass_directory = os.path.join(analysis_directory, "fastq_pass")
+    subdir_paths = []
     for subdir in os.listdir(fastq_pass_directory):
         subdir_path = os.path.join(fastq_pass_directory, subdir)
-        if os.path.isdir(subdir_path) and any(os.scandir(subdir_path)):
-            run_kraken(subdir_path, kraken_db_path, analyze_bacterial)
-            output_kraken = os.path.join(subdir_path, f"{os.path.basename(subdir_path)}.kreport.txt")
-            kreport_df = pd.read_csv(output_kraken, sep='\t', header=None)
-            kreport_dfs.append(kreport_df)
+        if os.path.isdir(subdir_path) and directory_is_nonempty(subdir_path):
+            subdir_paths.append(subdir_path)
         else:
             # For real-time analysis when the folder already exists but no file yet
             print(f"Skipping empty subdirectory: {subdir}")
 
-    # Combine all kreport.txt DataFrames into one DataFrame
-    combined_kreport = pd.concat(kreport_dfs)
-
-    # Duplicate and modify the DataFrame for "all" rows
-    combined_kreport_all = combined_kreport.copy()
-    combined_kreport_all[0] = "all"
-
-    # Concatenate the original DataFrame and the modified DataFrame
-    combined_kreport_final = pd.concat([combined_kreport, combined_kreport_all])
-
-    # Save the combined DataFrame with the dynamically generated output file name
+    # Run Kraken2 on several barcodes at once; --memory-mapping makes the
+    # workers share one page-cached copy of the database, so concurrency
+    # costs no extra database RAM
+    n_workers = max(1, min(4, len(subdir_paths)))
+    threads_per_call = max(1, os.cpu_count() // n_workers)
+    with multiprocessing.Pool(n_workers) as pool:
+        pool.starmap(run_kraken, [(subdir_path, kraken_db_path, analyze_bacterial, threads_per_call)
+                                  for subdir_path in subdir_paths])
+
+    kreport_paths = [os.path.join(subdir_path, f"{os.path.basename(subdir_path)}.kreport.txt")
+                     for subdir_path in subdir_paths]
+
+    # Stream each kreport into the combined file, then append the same rows
+    # retitled "all"; the reports are plain TSV already carrying a title
+    # column, so no DataFrame ever has to hold the whole table
     combined_output_path = os.path.join(analysis_directory, output_file_name)
-    combined_kreport_final.to_csv(combined_output_path, sep='\t', header=False, index=False)
+    with open(combined_output_path, 'w') as out:
+        for kreport_path in kreport_paths:
+            with open(kreport_path) as src:
+                shutil.copyfileobj(src, out)
+        for kreport_path in kreport_paths:
+            with open(kreport_path) as src:
+                for line in src:
+                    out.write('all\t' + line.split('\t', 1)[1])
 
     print(f"Kraken analysis results saved in {combined_output_path}")
 